@@ -21,41 +21,128 @@ This module reads the CSV file and converts it into inventory information.
 """
 
 import csv
+import functools
+import hashlib
 import yaml
 import json
+import os
 import sys
+import tempfile
+from collections import defaultdict
+
+try:
+    # LibYAML C binding
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 TYPE_STRING  = 'S'
 TYPE_INTEGER = 'I'
 TYPE_BOOLEAN = 'B'
 TYPE_FLOAT   = 'F'
 
-def load_csv_inventory(file_name):
+def load_csv_inventory(file_name, simple_csv=False):
     """
     Read inventory file in CSV format.
 
     :param string file_name: csv file name
+    :param bool simple_csv: True if the file has no quoted fields (see iter_csv_inventory).
     :rtype: array
     :return: node information array.
     """ 
 
-    # load csv
-    ret = []
+    return list(iter_csv_inventory(file_name, simple_csv))
+
+
+def iter_csv_inventory(file_name, simple_csv=False):
+    """
+    Read inventory file in CSV format one node at a time.
+    Nodes are yielded as they are read, so the caller does not have to
+    hold an intermediate copy of the whole file.
+    With simple_csv, the file is read at once and each line is split on
+    commas, which is faster than the csv module but does not handle
+    quoted fields.
 
-    with open(file_name, 'r') as csv_file:
-        reader = csv.reader(csv_file, dialect='excel')
+    :param string file_name: csv file name
+    :param bool simple_csv: True if the file has no quoted fields.
+    :rtype: generator
+    :return: node information generator.
+    """ 
+
+    with open(file_name, 'r', newline='') as csv_file:
+        if simple_csv:
+            rows = split_simple_csv(csv_file.read())
+        else:
+            rows = csv.reader(csv_file, dialect='excel')
         # load header
-        header = next(reader)
+        header = next(rows, None)
+        if header is None:
+            return
         header_info = load_header(header)
-        # load node information
-        for row in reader:
-            if len(row) <= 0:
+        if header_info is None:
+            bad_items = [item for item in header if parse_header_item(item) is None]
+            raise ValueError('%s: invalid header item %r (expected "<type>.<name>")'
+                             % (file_name, bad_items[0]))
+        compiled_header = compile_header(header_info)
+        # load node information (skip empty rows)
+        for row_no, row in enumerate(rows, 2):
+            if not row:
                 continue
+            if len(row) < len(compiled_header):
+                # csv.reader rows may span several lines (quoted line breaks),
+                # simple_csv rows are always one line
+                line_no = row_no if simple_csv else rows.line_num
+                raise ValueError('%s:%d: expected %d items, found %d'
+                                 % (file_name, line_no, len(compiled_header), len(row)))
+            yield load_node_info(compiled_header, row)
 
-            node_info = load_node_info(header_info, row)
-            ret.append(node_info)
 
-    return ret
+def split_simple_csv(text):
+    """
+    Split CSV text without quoted fields into rows.
+    Lines end at "\r\n", "\r" or "\n" only (unlike str.splitlines, which also
+    splits on characters such as "\f" or "\u2028" inside fields).
+    Empty lines give empty rows, as csv.reader does.
+
+    :param string text: CSV file content.
+    :rtype: generator
+    :return: row (array of items) generator.
+    """ 
+
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    # a final line ending does not start another row
+    if lines[-1] == '':
+        lines.pop()
+
+    for line in lines:
+        yield line.split(',') if line else []
+
+
+def prefetch_files(file_names):
+    """
+    Ask the kernel to start reading the given files in the background.
+    Reads for all inventory files are then in flight together, instead of
+    each file waiting for its own I/O when it is loaded.
+    Does nothing on platforms without posix_fadvise.
+
+    :param array file_names: file names to prefetch.
+    """ 
+
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    for file_name in file_names:
+        try:
+            fd = os.open(file_name, os.O_RDONLY)
+        except OSError:
+            # reported when the file is loaded
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
 
 
 def load_header(header):
@@ -70,32 +157,59 @@ def load_header(header):
     :return: Array of header information.
     """ 
 
-    ret = []
+    parsed = [parse_header_item(item) for item in header]
+    if None in parsed:
+        return None
 
-    for item in header:
-        item = item.strip()
-        elements = item.split('.')
-        if len(elements) >= 2:
-            # get item value type
-            item_type = elements[0].strip()
-            # get item name
-            item_name = elements[1].strip()
-            ret.append({'item_type': item_type, 'item_name': item_name})
-        else:
-            ret = None
-            break
+    return [{'item_type': item_type, 'item_name': item_name}
+            for item_type, item_name in parsed]
 
-    return ret
+
+@functools.lru_cache(maxsize=1024)
+def parse_header_item(item):
+    """
+    Split one header item into its value type and item name.
+    ex. "S.ansible_host" => ("S", "ansible_host")
+    Results are cached, since the same headers repeat across inventory files.
+
+    :param string item: Header item.
+    :rtype: tuple
+    :return: (item_type, item_name), or None if the item has no type prefix.
+    """ 
+
+    # the elements are stripped, so the item itself need not be
+    elements = item.split('.')
+    if len(elements) < 2:
+        return None
+
+    # (item value type, item name)
+    return (elements[0].strip(), elements[1].strip())
+
+
+def compile_header(header_info_array):
+    """
+    Compile header information into (item name, converter) pairs.
+    The converter for each column is looked up once here, instead of
+    dispatching on the item type for every cell.
+    ex. [("host_name", str), ("port_no", int), ...]
+
+    :param array header_info_array: Array of header information.
+    :rtype: array
+    :return: Array of (item_name, converter) tuples.
+    """ 
+
+    return [(header['item_name'], CONVERTERS.get(header['item_type'], str))
+            for header in header_info_array]
 
 
-def load_node_info(header_info_array, item_array):
+def load_node_info(compiled_header, item_array):
     """
     Read node information line.
     Returns an dict of node information.
     node information format => {item_name1: value1, item_name2: value2, ...}
     ex. {"host_name": "web001", "port_no": 80, ... }
 
-    :param array header_info_array: Array of .
+    :param array compiled_header: Array of (item_name, converter) from compile_header.
     :param array item_array: Array of node information.
     :rtype: dict
     :return: Dict of node information.
@@ -103,18 +217,11 @@ def load_node_info(header_info_array, item_array):
 
     ret = {}
 
-    pos = 0
-    for header in header_info_array:
-        # get item value
-        item = item_array[pos].strip()
-        item_type = header['item_type']
-        item_name = header['item_name']
-        # convert value
-        val = conv_str2value(item_type, item)
-        if val is not None:
-            ret[item_name] = val
-
-        pos += 1
+    for (item_name, conv), item in zip(compiled_header, item_array):
+        # get item value (empty items are omitted)
+        item = item.strip()
+        if item:
+            ret[item_name] = conv(item)
 
     return ret
 
@@ -126,111 +233,193 @@ def load_common_info(file_name):
     node information format => {item_name1: value1, item_name2: value2, ...}
     ex. {"host_name": "web001", "port_no": 80, ... }
 
+    The parsed result is cached on disk and reused while the file content is unchanged.
+
     :param string file_name: Name of common definition file in yaml format.
     :rtype: dict
     :return: Dict of common information.
     """ 
 
-    ret = None
-    with open(file_name, 'r') as common_file:
-        ret = yaml.load(common_file,Loader=yaml.FullLoader)
+    with open(file_name, 'rb') as common_file:
+        content = common_file.read()
+
+    digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+    cache_path = get_common_cache_path(file_name)
+    ret = read_common_cache(cache_path, digest)
+    if ret is not None:
+        return ret
+
+    ret = yaml.load(content, Loader=SafeLoader)
+
+    write_common_cache(cache_path, digest, ret)
 
     return ret
 
 
-def conv_str2value(item_type, item):
+def get_common_cache_path(file_name):
     """
-    Convert a character string to a specified data type.
+    Get the cache file path for a common definition file.
+    Cache files are stored under $XDG_CACHE_HOME/csv_inventory (default ~/.cache).
 
-    :param string item_type: A character string representing the type of item data.
-    :param string item: Value of item data.
-    :rtype: undecided
-    :return: The converted value.
+    :param string file_name: Name of common definition file in yaml format.
+    :rtype: string
+    :return: Cache file path.
+    """ 
+
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    key = hashlib.blake2b(os.path.abspath(file_name).encode('utf-8'),
+                          digest_size=16).hexdigest()
+
+    return os.path.join(cache_dir, 'csv_inventory', key + '.json')
+
+
+def read_common_cache(cache_path, digest):
+    """
+    Read cached common information.
+    The cache is only used if it was made from a file with the same content.
+
+    :param string cache_path: Cache file path.
+    :param string digest: content hash of the common definition file.
+    :rtype: dict
+    :return: Dict of common information, or None if there is no valid cache.
     """ 
 
-    ret = None
+    try:
+        with open(cache_path, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
 
-    if len(item) <= 0:
+    if not isinstance(cache, dict) or cache.get('digest') != digest:
         return None
 
-    if TYPE_STRING == item_type:
-        # set string value
-        ret = item
-    elif TYPE_INTEGER == item_type:
-        # set integer value
-        ret = int(item)
-    elif TYPE_BOOLEAN == item_type:
-        # set boolean value
-        item = item.lower()
-        if item == 'true':
-            ret = True
-        elif item == 'false':
-            ret = False
+    return cache.get('data')
+
+
+def write_common_cache(cache_path, digest, common_info):
+    """
+    Write common information to the cache.
+    Nothing is written if the information does not survive a JSON round trip
+    unchanged (e.g. non-string keys), or if it shares containers through YAML
+    anchors/aliases, which JSON would turn into separate copies.
+    Failures are ignored, the cache is only an optimization.
+
+    :param string cache_path: Cache file path.
+    :param string digest: content hash of the common definition file.
+    :param dict common_info: common information dictionary.
+    """ 
+
+    if has_shared_containers(common_info):
+        return
+
+    try:
+        if json.loads(json.dumps(common_info)) != common_info:
+            return
+    except (TypeError, ValueError):
+        # values that can not be written as JSON
+        return
+
+    cache_dir = os.path.dirname(cache_path)
+    tmp_path = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file and rename, so readers never see a partial cache
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.tmp',
+                                         delete=False) as cache_file:
+            tmp_path = cache_file.name
+            json.dump({'digest': digest, 'data': common_info}, cache_file)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # e.g. read-only home
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+def has_shared_containers(data):
+    """
+    Check whether a dict or list appears more than once in the data,
+    as happens with YAML anchors and aliases.
+
+    :param undecided data: data loaded from yaml.
+    :rtype: bool
+    :return: True if a container is shared.
+    """ 
+
+    seen = set()
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            children = item.values()
+        elif isinstance(item, list):
+            children = item
         else:
-            ret = False
-    elif TYPE_FLOAT == item_type:
-        # set float value
-        ret = float(item)
-    else:
-        # set value
-        ret = item
+            continue
+        if id(item) in seen:
+            return True
+        seen.add(id(item))
+        stack.extend(children)
 
-    return ret
+    return False
 
 
-def make_hostvars(node_info_array):
+def conv_str2bool(item):
     """
-    Generate hostvars from the node information array.
+    Convert a character string to a boolean.
+    Only "true" (case-insensitive) is True, anything else is False.
 
-    :param array node_info_array: Node information array.
-    :rtype: dict
-    :return: Dictionary of hostvars.
+    :param string item: Value of item data.
+    :rtype: bool
+    :return: The converted value.
     """ 
 
-    ret = {}
+    # only 4-character values can be "true"; skips lower() for the rest
+    return len(item) == 4 and item.lower() == 'true'
 
-    for node_info in node_info_array:
-        #" get host_name
-        host_name = node_info.pop('host_name', None)
-        if host_name is None:
-            ret = None
-            break
-        # make hostvar
-        ret[host_name] = node_info
 
-    return ret
+# converter for each item type
+CONVERTERS = {
+    TYPE_STRING: str,
+    TYPE_INTEGER: int,
+    TYPE_BOOLEAN: conv_str2bool,
+    TYPE_FLOAT: float,
+}
 
 
-def make_groups(hostvars):
+def make_hostvars_and_groups(node_info_array):
     """
-    Generate groups information from the hostvars.
+    Generate hostvars and groups information from the node information array
+    in a single pass over the nodes.
+    If a host appears in several rows, its last row wins, for both its
+    hostvars and the group it belongs to.
 
-    :param dict hostvars: hostvars.
-    :rtype: dict
-    :return: Dictionary of groups information.
+    :param array node_info_array: Node information array.
+    :rtype: tuple
+    :return: (Dictionary of hostvars, Dictionary of groups information).
     """ 
 
-    ret = {}
+    hostvars = {}
+    host_groups = {}
 
-    for node_name, node_info in hostvars.items():
-        # get group name
+    for node_info in node_info_array:
+        # get host_name and group name
+        host_name = node_info.pop('host_name', None)
         group_name = node_info.pop('group', None)
-        if group_name is None:
-            ret = None
-            break
-        # make groups
-        if group_name in ret:
-            group = ret[group_name]
-            hosts = group['hosts']
-            hosts.append(node_name)
-        else:
-            group = {}
-            hosts = []
-            hosts.append(node_name)
-            group['hosts'] = hosts
-            ret[group_name] = group
+        if host_name is None or group_name is None:
+            return None, None
+        # make hostvar
+        hostvars[host_name] = node_info
+        host_groups[host_name] = group_name
 
-    return ret
+    # make groups (each host once, in hostvars order)
+    groups = defaultdict(lambda: {'hosts': []})
+    for host_name, group_name in host_groups.items():
+        groups[group_name]['hosts'].append(host_name)
+
+    return hostvars, dict(groups)
 
 
 def get_groupvars(common_info):
@@ -244,12 +433,11 @@ def get_groupvars(common_info):
 
     ret = {}
     # get group_vars
-    group_vars = common_info.pop('group_vars', None)
+    group_vars = common_info.get('group_vars')
     if group_vars is not None: 
-        for name, val in group_vars.items():
-            ret[name] = val
+        ret.update(group_vars)
     # get all vars
-    all_vars = common_info.pop('all_vars', None)
+    all_vars = common_info.get('all_vars')
     if all_vars is not None: 
         ret['all'] = all_vars
 
@@ -282,27 +470,22 @@ def make_specific_items(node_info_array, groupvars, spec_vars):
     :rtype: array
     :return: Customized node information array.
     """ 
-    backend_array = []
+    # ha proxy backend information is only needed with an ha_proxy group
+    haproxy_group = groupvars.get('ha_proxy', None)
+    if haproxy_group is None:
+        return node_info_array
 
     def_port_no = groupvars['web_server']['port_no']
 
     # make ha proxy backend information
-    for node in node_info_array:
-        group = node['group']
-        if group == 'web_server':
-            host_name = node['host_name']
-            backend_ip = node['backend_ip']
-            port_no = node.get('port_no', def_port_no)
-            weight = node.get('weight', 1)
-            backend = {'host_name': host_name, 'backend_ip': backend_ip, 
-                       'port_no': port_no, 'weight': weight}
-            backend_array.append(backend)
+    web_nodes = [node for node in node_info_array if node.get('group') == 'web_server']
+    backend_array = [{'host_name': node['host_name'], 'backend_ip': node['backend_ip'],
+                      'port_no': node.get('port_no', def_port_no),
+                      'weight': node.get('weight', 1)}
+                     for node in web_nodes]
 
     # add web_backend
-    haproxy_group = groupvars.get('ha_proxy', None)
-    if haproxy_group is not None:
-        haproxy_group['web_backend'] = backend_array
-
+    haproxy_group['web_backend'] = backend_array
 
     return node_info_array
 
@@ -317,12 +500,13 @@ def main():
 
     # load inventory file
     inv_list = common_info.pop('inventory_list', ['inventory.csv'])
+    simple_csv = common_info.pop('simple_csv', False)
     node_info_array = []
+    if len(inv_list) > 1:
+        prefetch_files(inv_list)
     for file_name in inv_list:
         # load 
-        nodes = load_csv_inventory(file_name)
-        if nodes is not None:
-            node_info_array.extend(nodes)
+        node_info_array.extend(iter_csv_inventory(file_name, simple_csv))
 
     # get groupvars
     groupvars = get_groupvars(common_info)
@@ -331,8 +515,7 @@ def main():
     specific_vars = common_info.pop('specific_vars', {})
     node_info_array = make_specific_items(node_info_array, groupvars, specific_vars)
 
-    hostvars = make_hostvars(node_info_array)
-    groups = make_groups(hostvars)
+    hostvars, groups = make_hostvars_and_groups(node_info_array)
 
     # add groupvars
     add_groupvars(groups, groupvars)